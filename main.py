@@ -1,14 +1,22 @@
 # main.py
 
 # --- IMPORTS ---
-from fastapi import FastAPI, File, UploadFile, Form, Depends, Header, HTTPException
-from fastapi.responses import StreamingResponse
+from fastapi import FastAPI, File, UploadFile, Form, Depends, Header, HTTPException, Response
 from fastapi.middleware.cors import CORSMiddleware
 import qrcode
+import segno
 from qrcode.image.styledpil import StyledPilImage
 from qrcode.image.styles.colormasks import SolidFillColorMask
+import asyncio
+import concurrent.futures
+import functools
+import hashlib
 import io
-from PIL import Image, ImageColor
+import threading
+from anyio import CapacityLimiter, to_thread
+from cachetools import LRUCache
+import numpy as np
+from PIL import Image, ImageColor, ImageDraw, UnidentifiedImageError
 import os
 from qrcode.image.styles.moduledrawers import GappedSquareModuleDrawer, RoundedModuleDrawer, CircleModuleDrawer
 
@@ -16,6 +24,21 @@ from qrcode.image.styles.moduledrawers import GappedSquareModuleDrawer, RoundedM
 # --- CONFIGURATION ---
 RAPIDAPI_PROXY_SECRET = os.getenv("RAPIDAPI_PROXY_SECRET", "sUp3r-S3cr3t-Qu33n-b33-K3y-9z8y")
 MIN_CONTRAST_RATIO = 4.5
+MAX_LOGO_BYTES = 2 * 1024 * 1024
+ALLOWED_LOGO_TYPES = {"image/png", "image/jpeg", "image/webp"}
+
+# A logo never needs more pixels than this; anything bigger is a decompression
+# bomb as far as this service is concerned.
+Image.MAX_IMAGE_PIXELS = 4_000_000
+
+# Campaign-style codes share a fixed URL prefix with a short variable token.
+# Probing once with the worst-case payload pins the symbol version and mask,
+# so per-request generation skips auto-version fitting and 8-mask scoring.
+QR_TEMPLATE_PREFIX = os.getenv("QR_TEMPLATE_PREFIX", "https://example.com/c/")
+QR_TEMPLATE_MAX_TOKEN = 64
+_TEMPLATE_PROBE = segno.make(QR_TEMPLATE_PREFIX + "x" * QR_TEMPLATE_MAX_TOKEN, error="m", micro=False)
+QR_TEMPLATE_VERSION = _TEMPLATE_PROBE.version
+QR_TEMPLATE_MASK = _TEMPLATE_PROBE.mask
 
 # --- SECURITY DEPENDENCY ---
 async def verify_secret(x_api_secret: str = Header(None, alias="X-API-Secret")):
@@ -24,19 +47,34 @@ async def verify_secret(x_api_secret: str = Header(None, alias="X-API-Secret")):
     return x_api_secret
 
 # --- HELPER FUNCTIONS ---
+@functools.lru_cache(maxsize=512)
+def parse_color(name):
+    return ImageColor.getcolor(name, "RGB")
+
+# 256-entry sRGB -> linear table, computed once at import time. Each channel
+# has only 256 possible values, so the branched ** 2.4 gamma expansion never
+# needs to run per request.
+_SRGB_LUT = tuple(
+    x / 12.92 if x <= 0.03928 else ((x + 0.055) / 1.055) ** 2.4
+    for x in (c / 255.0 for c in range(256))
+)
+
 def get_relative_luminance(rgb):
-    r, g, b = [x / 255.0 for x in rgb]
-    r = r / 12.92 if r <= 0.03928 else ((r + 0.055) / 1.055) ** 2.4
-    g = g / 12.92 if g <= 0.03928 else ((g + 0.055) / 1.055) ** 2.4
-    b = b / 12.92 if b <= 0.03928 else ((b + 0.055) / 1.055) ** 2.4
-    return 0.2126 * r + 0.7152 * g + 0.0822 * b
+    r, g, b = rgb
+    return 0.2126 * _SRGB_LUT[r] + 0.7152 * _SRGB_LUT[g] + 0.0722 * _SRGB_LUT[b]
+
+@functools.lru_cache(maxsize=512)
+def contrast_ratio(fill_rgb, back_rgb):
+    # Signed contrast ratio: negative when the fill is lighter than the background.
+    lum_fill = get_relative_luminance(fill_rgb)
+    lum_back = get_relative_luminance(back_rgb)
+    ratio = (lum_back + 0.05) / (lum_fill + 0.05)
+    return -ratio if lum_fill > lum_back else ratio
 
 def check_color_contrast(color1_rgb, color2_rgb):
-    lum1 = get_relative_luminance(color1_rgb)
-    lum2 = get_relative_luminance(color2_rgb)
-    if lum1 > lum2:
+    ratio = contrast_ratio(color1_rgb, color2_rgb)
+    if ratio < 0:
         raise HTTPException(status_code=400, detail="Color Error: Fill color must be darker than the background color.")
-    ratio = (lum2 + 0.05) / (lum1 + 0.05)
     if ratio < MIN_CONTRAST_RATIO:
         raise HTTPException(status_code=400, detail=f"Low Contrast Error: Contrast ratio is {ratio:.2f}:1. Must be at least {MIN_CONTRAST_RATIO}:1.")
 
@@ -57,17 +95,243 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Typical rendered PNGs top out well under this, so a buffer preallocated to
+# it never regrows mid-encode.
+_PNG_BUF_SIZE = 32 * 1024
+
+def _png_buffer():
+    """BytesIO pre-sized for a PNG encode; writes overwrite in place instead
+    of repeatedly regrowing the buffer. Truncate after writing to trim."""
+    return io.BytesIO(bytes(_PNG_BUF_SIZE))
+
+# --- RESPONSE CACHE ---
+# Rendered PNGs keyed by everything that affects the output; a hit skips the
+# whole render pipeline. Guarded by a lock since renders run on worker threads.
+_PNG_CACHE = LRUCache(maxsize=1024)
+_PNG_CACHE_LOCK = threading.Lock()
+
+def _cache_get(key):
+    with _PNG_CACHE_LOCK:
+        return _PNG_CACHE.get(key)
+
+def _cache_put(key, png):
+    with _PNG_CACHE_LOCK:
+        _PNG_CACHE[key] = png
+
+# --- RENDER HELPERS (CPU-bound, run in the threadpool) ---
+# CPU-bound renders hold a worker thread for the whole request, so cap them
+# at the core count instead of sharing AnyIO's default 40-thread limiter.
+_RENDER_LIMITER = CapacityLimiter(os.cpu_count() or 4)
+
+# Renders run on worker threads. QRCode allocates its internal matrices on
+# construction and the module drawers hold the image they were initialized
+# with, so both are reused per-thread instead of rebuilt per request.
+_RENDER_LOCAL = threading.local()
+
+def _get_qr():
+    qr = getattr(_RENDER_LOCAL, "qr", None)
+    if qr is None:
+        # ECC-Q recovers up to 25% damage; the centered logo covers at most
+        # (width//4)^2 ~ 6% of the symbol, so H's 30% redundancy only bought
+        # a larger module matrix.
+        qr = qrcode.QRCode(error_correction=qrcode.constants.ERROR_CORRECT_Q, box_size=10, border=4)
+        _RENDER_LOCAL.qr = qr
+    qr.clear()
+    # clear() keeps the last symbol version and best_fit() only searches
+    # upward from it - drop it so each payload refits from scratch.
+    qr.version = None
+    return qr
+
+def _get_module_drawer(module_style):
+    drawers = getattr(_RENDER_LOCAL, "drawers", None)
+    if drawers is None:
+        drawers = {
+            "square": GappedSquareModuleDrawer(),
+            "rounded": RoundedModuleDrawer(),
+            "dot": CircleModuleDrawer(),
+        }
+        _RENDER_LOCAL.drawers = drawers
+    return drawers.get(module_style, drawers["square"])
+
+# Matches qrcode's CircleModuleDrawer oversample factor.
+_ANTIALIASING_FACTOR = 4
+_GAP_SIZE_RATIO = 0.8  # GappedSquareModuleDrawer default
+
+@functools.lru_cache(maxsize=8)
+def _module_tile_alpha(module_style, box_size):
+    """Coverage of one module cell as a (box_size, box_size) float array in
+    [0, 1], or None for styles whose shape depends on neighbouring modules."""
+    if module_style == "dot":
+        fake_size = box_size * _ANTIALIASING_FACTOR
+        tile = Image.new("L", (fake_size, fake_size), 0)
+        ImageDraw.Draw(tile).ellipse((0, 0, fake_size, fake_size), fill=255)
+        tile = tile.resize((box_size, box_size), Image.Resampling.LANCZOS)
+        return np.asarray(tile, dtype=np.float32) / 255.0
+    if module_style == "rounded":
+        return None  # corner rounding depends on the neighbouring modules
+    delta = round((1 - _GAP_SIZE_RATIO) * box_size / 2)
+    tile = np.zeros((box_size, box_size), dtype=np.float32)
+    tile[delta:box_size - delta, delta:box_size - delta] = 1.0
+    return tile
+
+def _render_modules(qr, fill, back, module_style):
+    """Paint the QR module matrix into a PIL image.
+
+    Styles drawn one module at a time by qrcode (plus SolidFillColorMask's
+    per-pixel recolor pass) are O(pixels) Python work; where the module shape
+    is position-independent the whole frame is a kron of the matrix with a
+    per-cell coverage tile, blended between back and fill in NumPy.
+    """
+    tile = _module_tile_alpha(module_style, qr.box_size)
+    if tile is None:
+        return qr.make_image(
+            image_factory=StyledPilImage,
+            module_drawer=_get_module_drawer(module_style),
+            color_mask=SolidFillColorMask(front_color=fill, back_color=back)
+        )
+    matrix = np.array(qr.get_matrix(), dtype=np.float32)  # border included
+    # The stock renderer draws the three 7x7 finder eyes with the solid
+    # default drawer, not the module drawer; mirror that distinction here.
+    n = len(qr.modules)
+    b = qr.border
+    eye = np.zeros_like(matrix)
+    eye[b:b + 7, b:b + 7] = 1.0
+    eye[b:b + 7, b + n - 7:b + n] = 1.0
+    eye[b + n - 7:b + n, b:b + 7] = 1.0
+    alpha = np.kron(matrix * (1 - eye), tile) + np.kron(matrix * eye, np.ones_like(tile))
+    alpha = alpha[..., None]
+    fill_arr = np.array(fill, dtype=np.float32)
+    back_arr = np.array(back, dtype=np.float32)
+    arr = (back_arr + alpha * (fill_arr - back_arr)).astype(np.uint8)
+    return Image.fromarray(arr, "RGB")
+
+def _render_basic_qr(url):
+    # segno packs the module matrix straight into 1-bit PNG scanlines, so the
+    # basic endpoint skips PIL entirely. Same geometry as the old qrcode
+    # defaults: ECC-M, 10px modules, 4-module border.
+    code = segno.make(url, error="m", micro=False)
+    buf = _png_buffer()
+    code.save(buf, kind="png", scale=10, border=4, compresslevel=1)
+    buf.truncate()
+    return bytes(buf.getbuffer())
+
+def _render_template_qr(token):
+    # Fixed version, fixed mask, explicit byte mode: segno skips the version
+    # fit, the mask-scoring pass and mode auto-detection entirely.
+    code = segno.make(
+        QR_TEMPLATE_PREFIX + token,
+        error="m",
+        micro=False,
+        version=QR_TEMPLATE_VERSION,
+        mask=QR_TEMPLATE_MASK,
+        mode="byte",
+        boost_error=False,
+    )
+    buf = _png_buffer()
+    code.save(buf, kind="png", scale=10, border=4, compresslevel=1)
+    buf.truncate()
+    return bytes(buf.getbuffer())
+
+def _render_custom_qr(url, fill, back, module_style, logo_bytes):
+    qr = _get_qr()
+    qr.add_data(url)
+
+    qr_img = _render_modules(qr, fill, back, module_style)
+
+    logo_img = Image.open(io.BytesIO(logo_bytes))
+    qr_width, qr_height = qr_img.size
+    logo_max_size = qr_width // 4
+    # For JPEG logos draft mode decodes directly at a reduced DCT scale, so a
+    # large photo never materializes at full resolution. No-op for PNGs.
+    logo_img.draft("RGB", (logo_max_size, logo_max_size))
+    # Only route through the alpha pipeline when the logo can actually be
+    # transparent; opaque logos take the raw-copy paste path instead.
+    has_alpha = "A" in logo_img.getbands() or "transparency" in logo_img.info
+    if has_alpha:
+        if logo_img.mode != "RGBA":
+            logo_img = logo_img.convert("RGBA")
+    elif logo_img.mode != "RGB":
+        logo_img = logo_img.convert("RGB")
+    # reducing_gap lets Pillow do a cheap integer box-reduce before the final
+    # Lanczos pass instead of resampling from the full source.
+    logo_img.thumbnail((logo_max_size, logo_max_size), reducing_gap=2.0)
+    pos = ((qr_width - logo_img.size[0]) // 2, (qr_height - logo_img.size[1]) // 2)
+    if has_alpha:
+        # In-place alpha_composite is a single C pass; paste with a mask image
+        # goes through the much slower per-pixel blend path.
+        qr_img = qr_img.convert("RGBA")
+        qr_img.alpha_composite(logo_img, pos)
+        qr_img = qr_img.convert("RGB")
+    else:
+        qr_img.paste(logo_img, pos)
+
+    buf = _png_buffer()
+    qr_img.save(buf, "PNG", optimize=False, compress_level=1)
+    buf.truncate()
+    return bytes(buf.getbuffer())
+
+# --- RENDER PROCESS POOL ---
+# The custom render path is GIL-bound Python (module drawing for the rounded
+# style, NumPy orchestration, PIL composites), so worker threads alone cannot
+# use more than one core per uvicorn worker. A shared process pool lets
+# concurrent custom renders run in true parallel. Basic/template renders stay
+# on threads: segno finishes in ~1ms and pickling would cost more than it buys.
+_RENDER_POOL = None
+
+@app.on_event("startup")
+async def start_render_pool():
+    global _RENDER_POOL
+    # Every uvicorn worker builds its own pool, so give each its share of the
+    # cores rather than cpu_count() apiece (the __main__ runner exports the
+    # resolved WEB_CONCURRENCY; a single worker keeps the whole machine).
+    web_concurrency = max(1, int(os.getenv("WEB_CONCURRENCY", 1)))
+    pool_size = max(1, (os.cpu_count() or 1) // web_concurrency)
+    _RENDER_POOL = concurrent.futures.ProcessPoolExecutor(max_workers=pool_size)
+
+@app.on_event("shutdown")
+async def stop_render_pool():
+    if _RENDER_POOL is not None:
+        _RENDER_POOL.shutdown(wait=False, cancel_futures=True)
+
+# --- STARTUP WARMUP ---
+@app.on_event("startup")
+async def warm_render_path():
+    # The first render after a cold start pays for PIL/qrcode lazy imports
+    # and per-thread drawer setup; render a throwaway code for every style
+    # before traffic arrives so no request foots that bill.
+    def _warm():
+        _render_basic_qr("https://example.com/warmup")
+        for style in ("square", "rounded", "dot"):
+            qr = _get_qr()
+            qr.add_data("https://example.com/warmup")
+            img = _render_modules(qr, (0, 0, 0), (255, 255, 255), style)
+            img.save(io.BytesIO(), "PNG", optimize=False, compress_level=1)
+    await to_thread.run_sync(_warm, limiter=_RENDER_LIMITER)
+
 # --- API ENDPOINTS ---
-@app.get("/generate-basic", response_class=StreamingResponse, tags=["QR Code Generation"]) # <-- FIX: Trailing slash removed
-def generate_basic_qr_code(url: str):
-    img = qrcode.make(url)
-    buf = io.BytesIO()
-    img.save(buf, "PNG")
-    buf.seek(0)
-    return StreamingResponse(buf, media_type="image/png")
-
-@app.post("/generate-custom", response_class=StreamingResponse, tags=["QR Code Generation"]) # <-- FIX: Trailing slash removed
-def generate_custom_qr_code(
+@app.get("/generate-basic", response_class=Response, tags=["QR Code Generation"]) # <-- FIX: Trailing slash removed
+async def generate_basic_qr_code(url: str):
+    key = ("basic", url)
+    png = _cache_get(key)
+    if png is None:
+        png = await to_thread.run_sync(_render_basic_qr, url, limiter=_RENDER_LIMITER)
+        _cache_put(key, png)
+    return Response(content=png, media_type="image/png")
+
+@app.get("/generate-template/{token}", response_class=Response, tags=["QR Code Generation"])
+async def generate_template_qr_code(token: str):
+    # The probed capacity is in encoded bytes, not characters.
+    if len(token.encode("utf-8")) > QR_TEMPLATE_MAX_TOKEN:
+        raise HTTPException(status_code=400, detail=f"Token too long; {QR_TEMPLATE_MAX_TOKEN} bytes maximum.")
+    key = ("template", token)
+    png = _cache_get(key)
+    if png is None:
+        png = await to_thread.run_sync(_render_template_qr, token, limiter=_RENDER_LIMITER)
+        _cache_put(key, png)
+    return Response(content=png, media_type="image/png")
+
+@app.post("/generate-custom", response_class=Response, tags=["QR Code Generation"]) # <-- FIX: Trailing slash removed
+async def generate_custom_qr_code(
     url: str = Form(...),
     logo_file: UploadFile = File(...),
     fill_color: str = Form("black"),
@@ -75,43 +339,59 @@ def generate_custom_qr_code(
     module_style: str = Form("square", enum=["square", "rounded", "dot"]),
 ):
     try:
-        fill = ImageColor.getcolor(fill_color, "RGB")
-        back = ImageColor.getcolor(back_color, "RGB")
+        fill = parse_color(fill_color)
+        back = parse_color(back_color)
         check_color_contrast(fill, back)
     except ValueError:
         raise HTTPException(status_code=400, detail="Invalid color name provided.")
     except HTTPException as e:
         raise e
 
-    if module_style == "rounded":
-        drawer = RoundedModuleDrawer()
-    elif module_style == "dot":
-        drawer = CircleModuleDrawer()
-    else:
-        drawer = GappedSquareModuleDrawer()
-
-    qr = qrcode.QRCode(error_correction=qrcode.constants.ERROR_CORRECT_H, box_size=10, border=4)
-    qr.add_data(url)
-
-    qr_img = qr.make_image(
-        image_factory=StyledPilImage,
-        module_drawer=drawer,
-        color_mask=SolidFillColorMask(front_color=fill, back_color=back)
-    )
+    # Reject hopeless uploads before any bytes hit the decoder.
+    if logo_file.size and logo_file.size > MAX_LOGO_BYTES:
+        raise HTTPException(status_code=413, detail="Logo file too large; 2MB maximum.")
+    if logo_file.content_type not in ALLOWED_LOGO_TYPES:
+        raise HTTPException(status_code=415, detail="Unsupported logo type; upload PNG, JPEG or WebP.")
 
-    logo_img = Image.open(logo_file.file).convert("RGBA")
-    qr_width, qr_height = qr_img.size
-    logo_max_size = qr_width // 4
-    logo_img.thumbnail((logo_max_size, logo_max_size))
-    pos = ((qr_width - logo_img.size[0]) // 2, (qr_height - logo_img.size[1]) // 2)
-    qr_img.paste(logo_img, pos, mask=logo_img)
+    logo_bytes = await logo_file.read()
+    # Opening only parses the header, so this is a cheap way to turn bombs and
+    # mislabeled bytes into client errors instead of 500s from the render.
+    try:
+        Image.open(io.BytesIO(logo_bytes))
+    except Image.DecompressionBombError:
+        raise HTTPException(status_code=413, detail="Logo image dimensions too large.")
+    except UnidentifiedImageError:
+        raise HTTPException(status_code=400, detail="Logo file is not a valid image.")
 
-    buf = io.BytesIO()
-    qr_img.save(buf, "PNG")
-    buf.seek(0)
-    return StreamingResponse(buf, media_type="image/png")
+    logo_digest = hashlib.blake2b(logo_bytes, digest_size=16).digest()
+    key = ("custom", url, fill, back, module_style, logo_digest)
+    png = _cache_get(key)
+    if png is None:
+        if _RENDER_POOL is not None:
+            png = await asyncio.get_running_loop().run_in_executor(
+                _RENDER_POOL, _render_custom_qr, url, fill, back, module_style, logo_bytes
+            )
+        else:
+            png = await to_thread.run_sync(
+                _render_custom_qr, url, fill, back, module_style, logo_bytes,
+                limiter=_RENDER_LIMITER,
+            )
+        _cache_put(key, png)
+    return Response(content=png, media_type="image/png")
 
 # --- SERVER RUN COMMAND ---
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=int(os.getenv("PORT", 8000)))
\ No newline at end of file
+    workers = int(os.getenv("WEB_CONCURRENCY", os.cpu_count() or 1))
+    # Export the resolved count so each worker sizes its render pool to its
+    # fair share of the cores (see start_render_pool).
+    os.environ["WEB_CONCURRENCY"] = str(workers)
+    # Import string (not the app object) so uvicorn can fork workers.
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=int(os.getenv("PORT", 8000)),
+        loop="uvloop",
+        http="httptools",
+        workers=workers,
+    )
\ No newline at end of file